@@ -1,23 +1,34 @@
 from __future__ import annotations
 from typing import Sequence
 
+import atexit
+import collections
 import configparser
-import distutils
 import enum
+import functools
+import http.client
 import json
-import re
-import requests
+import logging
+import os
+import queue
 import sys
 import socket
-import subprocess
 import signal
 import threading 
 import time
+import types
 
 CONFIG_FILE = 'gpc.conf'
 
+log = logging.getLogger('gpc')
+
 class GoPro:
+    __slots__ = ('ap_ssid', 'ap_password', 'ip_address', 'mac_address', 'keepalive_period', 'connection', 'wol_payload', 'wol_sock', 'activity', 'last_command', 'streaming')
+    base_path = '/gp/gpControl'
+    http_timeout = 2
+    keepalive_idle_timeout = 60
     udp_port = 8554
+    wake_on_lan_port = 9
 
     def __init__(self, config: configparser.ConfigParser) -> None:
         self.ap_ssid = config['gopro']['ap_ssid']
@@ -25,6 +36,29 @@ class GoPro:
         self.ip_address = config['gopro']['ip_address']
         self.mac_address = config['gopro']['mac_address']
         self.keepalive_period = config['gopro'].getint('keepalive_period')
+        self.connection = http.client.HTTPConnection(self.ip_address, timeout=self.http_timeout)
+        self.wol_payload = bytes.fromhex('FF' * 6 + self.mac_address * 16)
+        self.wol_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.wol_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.activity = threading.Condition()
+        self.last_command = time.monotonic()
+        self.streaming = False
+
+    def mark_active(self) -> None:
+        with self.activity:
+            self.last_command = time.monotonic()
+            self.activity.notify()
+
+    def set_streaming(self, streaming: bool) -> None:
+        with self.activity:
+            self.streaming = streaming
+            self.last_command = time.monotonic()
+            self.activity.notify()
+
+    def wait_until_active(self) -> None:
+        with self.activity:
+            while not self.streaming and time.monotonic() - self.last_command > self.keepalive_idle_timeout:
+                self.activity.wait()
 
 @enum.unique
 class CommandEnum(enum.Enum):
@@ -44,145 +78,205 @@ class CommandEnum(enum.Enum):
     WAKE = 'wake'
     ZOOM = 'zoom'
 
+_COMMAND_BY_VALUE = {command.value: command for command in CommandEnum}
+_EMPTY = ()
+
+_RAW_DEFINITIONS = {
+    CommandEnum.DEFAULT_BOOT_MODE: {'arity': 1, 'template': '/setting/53/{}', 'mapping': {'video': '0', 'photo': '1', 'multishot': '2'}},
+    CommandEnum.DISPLAY_ON: {'arity': 0, 'template': '/setting/58/1'},
+    CommandEnum.DISPLAY_OFF: {'arity': 0, 'template': '/setting/58/0'},
+    CommandEnum.GET_INFO: {'arity': 0, 'template': '', 'want_result': True},
+    CommandEnum.GET_STATUS: {'arity': 0, 'template': '/status', 'want_result': True},
+    CommandEnum.GET_BATTERY_LEVEL: {'arity': 0, 'template': '/status', 'want_result': True},
+    CommandEnum.POWER_OFF: {'arity': 0, 'template': '/command/system/sleep'},
+    CommandEnum.RECORD_START: {'arity': 0, 'template': '/command/shutter?p=1'},
+    CommandEnum.RECORD_STOP: {'arity': 0, 'template': '/command/shutter?p=0'},
+    CommandEnum.STREAM: {'arity': 0, 'template': '/execute?p1=gpStream&a1=proto_v2&c1=restart'},
+    CommandEnum.STREAM_BITRATE: {'arity': 1, 'template': '/setting/62/{}'},
+    CommandEnum.STREAM_RESOLUTION: {'arity': 1, 'template': '/setting/64/{}', 'mapping': {'720p': '7', '480p': '4', '240p': '1'}},
+    CommandEnum.VIDEO_RESOLUTION: {'arity': 1, 'template': '/setting/2/{}', 'mapping': {'4k': '1', '1440p': '7', '1080p': '9', '720p': '12'}},
+    CommandEnum.WAKE: {'arity': 0, 'template': ''},
+    CommandEnum.ZOOM: {'arity' : 1,  'template': '/command/digital_zoom?range_pcnt={}'},
+}
+
+Definition = collections.namedtuple('Definition', 'arity mapping want_result prefix suffix')
+
+def _freeze_definition(definition: dict) -> Definition:
+    mapping = definition.get('mapping')
+    prefix, _, suffix = definition['template'].partition('{}')
+    return Definition(definition['arity'], types.MappingProxyType(mapping) if mapping else None, definition.get('want_result', False), prefix, suffix)
+
 class Command:
-    definitions = {
-            CommandEnum.DEFAULT_BOOT_MODE: {'arity': 1, 'template': '/setting/53/{}', 'mapping': {'video': '0', 'photo': '1', 'multishot': '2'}},
-            CommandEnum.DISPLAY_ON: {'arity': 0, 'template': '/setting/58/1'},
-            CommandEnum.DISPLAY_OFF: {'arity': 0, 'template': '/setting/58/0'},
-            CommandEnum.GET_INFO: {'arity': 0, 'template': '', 'want_result': True},
-            CommandEnum.GET_STATUS: {'arity': 0, 'template': '/status', 'want_result': True},
-            CommandEnum.GET_BATTERY_LEVEL: {'arity': 0, 'template': '/status', 'want_result': True},
-            CommandEnum.POWER_OFF: {'arity': 0, 'template': '/command/system/sleep'},
-            CommandEnum.RECORD_START: {'arity': 0, 'template': '/command/shutter?p=1'},
-            CommandEnum.RECORD_STOP: {'arity': 0, 'template': '/command/shutter?p=0'},
-            CommandEnum.STREAM: {'arity': 0, 'template': '/execute?p1=gpStream&a1=proto_v2&c1=restart'},
-            CommandEnum.STREAM_BITRATE: {'arity': 1, 'template': '/setting/62/{}'},
-            CommandEnum.STREAM_RESOLUTION: {'arity': 1, 'template': '/setting/64/{}', 'mapping': {'720p': '7', '480p': '4', '240p': '1'}},
-            CommandEnum.VIDEO_RESOLUTION: {'arity': 1, 'template': '/setting/2/{}', 'mapping': {'4k': '1', '1440p': '7', '1080p': '9', '720p': '12'}},
-            CommandEnum.WAKE: {'arity': 0, 'template': ''},
-            CommandEnum.ZOOM: {'arity' : 1,  'template': '/command/digital_zoom?range_pcnt={}'},
-    }
+    definitions = types.MappingProxyType({command: _freeze_definition(definition) for command, definition in _RAW_DEFINITIONS.items()})
 
 class Message:
+    __slots__ = ('command', 'args', '_prefix', '_suffix', '_want')
+
     def __init__(self, command: CommandEnum, args: Sequence[str] = []) -> None:
         self.command = command
         self.args = args
+        definition = Command.definitions[command]
+        self._prefix = definition.prefix
+        self._suffix = definition.suffix
+        self._want = definition.want_result
 
     @classmethod
-    def from_text(cls: Message, message_text: str) -> Message:
-        command = None
-        for com, definition in Command.definitions.items():
-            if com.value == message_text[0]:
-                command = com
+    def from_text(cls: Message, message_text: Sequence[str]) -> Message:
+        command = _COMMAND_BY_VALUE.get(message_text[0])
         if command is None:
             raise ValueError(f'Command "{message_text[0]}" does not exist.')
 
         definition = Command.definitions[command]
-        arity = definition['arity']
-        if len(message_text[1:]) != arity:
-            raise ValueError(f'{self.command.value} takes {arity} argument(s); got {len(message_text[1:])}.')
-        args = message_text[1 : arity + 1]
-        if 'mapping' in definition:
-            mapping = definition['mapping'] 
-            for i, arg in enumerate(args):
-                if arg not in mapping:
-                    raise ValueError(f'{self.command.value}: unknown argument "{arg}".')
-                args[i] = mapping[arg]
+        arity = definition.arity
+        nargs = len(message_text) - 1
+        if nargs != arity:
+            raise ValueError(f'{command.value} takes {arity} argument(s); got {nargs}.')
+        args = message_text[1:] if arity > 0 else _EMPTY
+        mapping = definition.mapping
+        if mapping is not None:
+            try:
+                args = [mapping[arg] for arg in args]
+            except KeyError as e:
+                raise ValueError(f'{command.value}: unknown argument "{e.args[0]}".') from None
         return cls(command, args)
 
-    def send_to(self, gopro: GoPro) -> str:
+    def send_to(self, gopro: GoPro) -> dict | int | str | None:
+        gopro.mark_active()
         if self.command == CommandEnum.WAKE:
-            Debug.print(f'WOL {gopro.mac_address}')
+            log.debug('WOL %s', gopro.mac_address)
             send_wake_on_lan(gopro)
             return ''
         if self.command == CommandEnum.GET_BATTERY_LEVEL:
-            return Message(CommandEnum.GET_STATUS).send_to(gopro).json()['status']['2']
+            return Message(CommandEnum.GET_STATUS).send_to(gopro)['status']['2']
         else:
-            Debug.print("GET " + self._build_url(gopro))
-            reply = requests.get(self._build_url(gopro))
+            path = self._build_path(gopro)
+            log.debug('GET http://%s%s', gopro.ip_address, path)
+            reply = self._get(gopro, path)
             if self._want_result():
-                return reply
+                return json.loads(reply, strict=False)
             else:
                 return None
 
-    def _build_url(self, gopro: GoPro) -> str:
-        return f'http://{gopro.ip_address}/gp/gpControl{Command.definitions[self.command]["template"].format(*self.args)}'
+    def _get(self, gopro: GoPro, path: str) -> bytes:
+        connection = gopro.connection
+        retry = connection.sock is not None
+        while True:
+            try:
+                connection.request('GET', path)
+                return connection.getresponse().read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                connection.close()
+                if not retry:
+                    raise
+                retry = False
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                raise
+
+    def _build_path(self, gopro: GoPro) -> str:
+        if self.args:
+            return f'{gopro.base_path}{self._prefix}{self.args[0]}{self._suffix}'
+        return gopro.base_path + self._prefix
 
     def _want_result(self) -> bool:
-        definition = Command.definitions[self.command]
-        return 'want_result' in definition and definition['want_result']
+        return self._want
 
     def __repr__(self) -> str:
         return f'{self.command} {self.args}' 
 
+_ZERO_ARG_MESSAGES = {command.value.encode(): Message(command, _EMPTY) for command, definition in Command.definitions.items() if definition.arity == 0}
+
 def main() -> int:
-    config = configparser.ConfigParser()
     try:
-        with open(CONFIG_FILE, "r") as config_file:
-            config.read_file(config_file)
+        config = _load_config(CONFIG_FILE, os.stat(CONFIG_FILE).st_mtime_ns)
     except IOError:
-        Debug.print(f"{CONFIG_FILE}: configuration file not found.")
+        log.debug('%s: configuration file not found.', CONFIG_FILE)
         sys.exit(1)
-    if config['gpc'].getboolean('debug', fallback=False):
-        Debug.enable()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.DEBUG if config['gpc'].getboolean('debug', fallback=False) else logging.WARNING)
 
     gopro = GoPro(config)
+    atexit.register(gopro.connection.close)
     send_wake_on_lan(gopro)
     keepalive_thread = threading.Thread(target=keepalive, args=(gopro,), daemon=True)
     keepalive_thread.start()
-    if Debug.enabled(): 
-        gopro_info = Message(CommandEnum.GET_INFO).send_to(gopro).json(strict=False)['info']
+    if log.isEnabledFor(logging.DEBUG):
+        gopro_info = Message(CommandEnum.GET_INFO).send_to(gopro)['info']
         gopro_battery_level = Message(CommandEnum.GET_BATTERY_LEVEL).send_to(gopro)
-        Debug.print(f"Model:\t\t\t{gopro_info['model_name']} (model {gopro_info['model_number']})")
-        Debug.print(f"Firmware:\t\t{gopro_info['firmware_version']}")
-        Debug.print(f"Serial:\t\t\t{gopro_info['serial_number']}")
-        Debug.print(f"AP SSID:\t\t{gopro_info['ap_ssid']}")
-        Debug.print(f"AP MAC:\t\t\t{gopro_info['ap_mac']}")
-        Debug.print(f"Battery level:\t\t{gopro_battery_level}")
-
-    for line in sys.stdin:
-        command_text = line.strip()
+        log.debug('Model:\t\t\t%s (model %s)', gopro_info['model_name'], gopro_info['model_number'])
+        log.debug('Firmware:\t\t%s', gopro_info['firmware_version'])
+        log.debug('Serial:\t\t\t%s', gopro_info['serial_number'])
+        log.debug('AP SSID:\t\t%s', gopro_info['ap_ssid'])
+        log.debug('AP MAC:\t\t\t%s', gopro_info['ap_mac'])
+        log.debug('Battery level:\t\t%s', gopro_battery_level)
+
+    messages = queue.Queue()
+    send_thread = threading.Thread(target=send_worker, args=(messages, gopro, config), daemon=True)
+    send_thread.start()
+    stdin = sys.stdin.buffer
+    while True:
+        line = stdin.readline()
+        if not line:
+            break
+        parts = line.split()
+        if not parts:
+            continue
+        message = _ZERO_ARG_MESSAGES.get(parts[0]) if len(parts) == 1 else None
+        if message is not None:
+            messages.put(message)
+            continue
         try:
-            message = Message.from_text(command_text.split(' '))
+            message = Message.from_text([part.decode('ascii') for part in parts])
         except ValueError as e:
-            Debug.print(f'Error for "{command_text}": {e}')
+            log.debug('Error for "%s": %s', line.decode('ascii', 'replace').strip(), e)
             continue
-        reply = message.send_to(gopro)
-        if reply:
-            print(reply)
-
-        if message.command == CommandEnum.STREAM:
-            subprocess.run([f'{config["gpc"]["mpv-path"]}', '--profile=low-latency', f'udp://{gopro.ip_address}:{gopro.udp_port}'])
+        messages.put(message)
 
+    messages.join()
     sys.exit(0)
 
-def keepalive(gopro: GoPro) -> None:
+def send_worker(messages: queue.Queue, gopro: GoPro, config: configparser.ConfigParser) -> None:
     while True:
-        keepalive_payload = "_GPHD_:0:0:2:0.000000\n".encode()
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(keepalive_payload, (gopro.ip_address, gopro.udp_port))
-        time.sleep(gopro.keepalive_period / 1000)
-
-def send_wake_on_lan(gopro: GoPro) -> None:
-    GOPRO_WAKE_ON_LAN_PORT = 9
-    hex_message = f'FFFFFFFFFFFF{gopro.mac_address * 16}'
-    payload = bytes.fromhex(hex_message)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    sock.sendto(payload, (gopro.ip_address, GOPRO_WAKE_ON_LAN_PORT))
+        message = messages.get()
+        try:
+            reply = message.send_to(gopro)
+            if reply:
+                print(reply)
 
-class Debug:
-    _debug = bool()
+            if message.command == CommandEnum.STREAM:
+                import subprocess
+                gopro.set_streaming(True)
+                try:
+                    subprocess.run([f'{config["gpc"]["mpv-path"]}', '--profile=low-latency', f'udp://{gopro.ip_address}:{gopro.udp_port}'])
+                finally:
+                    gopro.set_streaming(False)
+        except Exception as e:
+            log.warning('Error for "%s": %s', message, e)
+        finally:
+            messages.task_done()
 
-    def enabled() -> bool:
-        return Debug._debug
+@functools.lru_cache(maxsize=4)
+def _load_config(path: str, mtime_ns: int) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    with open(path, "r") as config_file:
+        config.read_file(config_file)
+    return config
 
-    def enable() -> None:
-        Debug._debug = True
+def keepalive(gopro: GoPro) -> None:
+    keepalive_payload = b'_GPHD_:0:0:2:0.000000\n'
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        while True:
+            gopro.wait_until_active()
+            sock.sendto(keepalive_payload, (gopro.ip_address, gopro.udp_port))
+            time.sleep(gopro.keepalive_period / 1000)
+    finally:
+        sock.close()
 
-    def print(message: str) -> None:
-        if Debug.enabled():
-            print(message, file=sys.stderr)
+def send_wake_on_lan(gopro: GoPro) -> None:
+    gopro.wol_sock.sendto(gopro.wol_payload, (gopro.ip_address, gopro.wake_on_lan_port))
 
 def signal_quit(signal, frame) -> None:
     sys.exit(0)